@@ -1,12 +1,22 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+
 import os
 import sys
-import json
+import tempfile
+import time
+import functools
 import hashlib
-from datetime import datetime, timedelta
-from twilio.rest import Client
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+import io
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, NamedTuple, Optional, Tuple, cast
+
+if TYPE_CHECKING:
+    from sendgrid import SendGridAPIClient
+    from twilio.rest import Client
+    from twilio.rest.api.v2010.account.call import CallInstance
 
 # Twilio credentials
 TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
@@ -17,13 +27,54 @@ SENDGRID_API_KEY = os.environ.get('SENDGRID_API_KEY')
 NOTIFICATION_EMAIL = os.environ.get('NOTIFICATION_EMAIL')
 FROM_EMAIL = os.environ.get('FROM_EMAIL')
 
+# NOTIFICATION_EMAIL may list several comma-separated recipients
+NOTIFICATION_RECIPIENTS = [email.strip() for email in (NOTIFICATION_EMAIL or '').split(',') if email.strip()]
+
 # Threshold for long calls (10 minutes in seconds)
 LONG_CALL_THRESHOLD = 10 * 60
 
+# Call statuses that count as active
+ACTIVE_STATUSES = frozenset({'in-progress', 'ringing', 'queued'})
+
+# Order in which a call moves through statuses, used to keep its latest state
+_STATUS_PROGRESSION: Dict[str, int] = {'queued': 0, 'ringing': 1, 'in-progress': 2, 'completed': 3}
+
+# Which list each Twilio call status is collected into
+_STATUS_DISPATCH: Dict[str, str] = {**dict.fromkeys(ACTIVE_STATUSES, 'active'), 'completed': 'long'}
+
 # File to store previous notification data
-LAST_NOTIFICATION_FILE = "/tmp/twilio_last_notification.json"
+LAST_NOTIFICATION_FILE = "/tmp/twilio_last_notification"
+
+# How long the last notification is trusted from memory before re-reading the file (1 hour)
+DEDUP_CACHE_TTL = 60 * 60
+
+# In-process cache of the last notification: (hash, epoch, cached_at)
+_dedup_cache: Dict[str, Tuple[str, int, float]] = {}
+
+class CallInfo(NamedTuple):
+    """Details of a detected call used for notifications."""
+    sid: Optional[str]
+    from_number: Optional[str]
+    to_number: Optional[str]
+    status: str
+    start_time: Optional[datetime]
+    duration: str
 
-def format_duration(seconds_str):
+def create_twilio_client() -> Client:
+    """Create a Twilio client; its HTTP client is not thread-safe, so each query thread needs its own."""
+    # Imported lazily to keep cron start-up fast
+    from twilio.rest import Client
+    
+    return Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+
+@functools.lru_cache(maxsize=1)
+def get_sendgrid_client() -> SendGridAPIClient:
+    """Return a shared SendGrid client."""
+    from sendgrid import SendGridAPIClient
+    
+    return SendGridAPIClient(SENDGRID_API_KEY)
+
+def format_duration(seconds_str: Optional[str]) -> str:
     """Format seconds into a human-readable duration."""
     if seconds_str is None:
         return "In progress"
@@ -44,111 +95,179 @@ def format_duration(seconds_str):
     else:
         return f"{seconds}s"
 
-def calculate_notification_hash(long_calls, in_progress_calls):
-    """Calculate a hash of the call data to track duplicates."""
-    combined_data = []
-    
-    # Add long calls data
-    for call in long_calls:
-        combined_data.append(f"{call['sid']}:{call['duration']}")
-    
-    # Add in-progress calls data
-    for call in in_progress_calls:
-        combined_data.append(f"{call['sid']}:{call['status']}")
-    
-    # Sort for consistency
-    combined_data.sort()
-    
-    # Create a single string and hash it
-    data_string = "|".join(combined_data)
-    return hashlib.md5(data_string.encode()).hexdigest()
+def format_start_time(start_time: Optional[datetime]) -> str:
+    """Format a call start time for display."""
+    if start_time is None:
+        return "Unknown"
+    # Twilio times are UTC; drop the offset to keep the display compact
+    return start_time.replace(tzinfo=None).isoformat(sep=' ', timespec='seconds')
 
-def is_duplicate_notification(long_calls, in_progress_calls):
-    """Check if this notification is a duplicate of the previous one."""
-    current_hash = calculate_notification_hash(long_calls, in_progress_calls)
+def load_last_notification() -> Optional[Tuple[str, int]]:
+    """Return the (hash, epoch) of the previous notification, or None if there is none."""
+    cached = _dedup_cache.get('last_notification')
+    if cached and time.monotonic() - cached[2] < DEDUP_CACHE_TTL:
+        return cached[:2]
     
+    # Fall back to the file ("<hash> <epoch>")
+    if not os.path.exists(LAST_NOTIFICATION_FILE):
+        return None
+    with open(LAST_NOTIFICATION_FILE, 'r') as f:
+        last_hash, last_epoch = f.read().split()
+    _dedup_cache['last_notification'] = (last_hash, int(last_epoch), time.monotonic())
+    return last_hash, int(last_epoch)
+
+def is_duplicate_notification(current_hash: str) -> bool:
+    """Check if a notification with this hash is a duplicate of the previous one."""
     try:
-        # Check if we have a previous notification file
-        if os.path.exists(LAST_NOTIFICATION_FILE):
-            with open(LAST_NOTIFICATION_FILE, 'r') as f:
-                last_data = json.load(f)
-                last_hash = last_data.get('hash', '')
-                last_time = last_data.get('time', '')
-                
-                # If hash matches, it's a duplicate
-                if current_hash == last_hash:
-                    print(f"Duplicate notification detected. Last sent at {last_time}")
-                    return True
+        last_notification = load_last_notification()
+        
+        # If hash matches, it's a duplicate
+        if last_notification and current_hash == last_notification[0]:
+            last_time = datetime.fromtimestamp(last_notification[1]).strftime('%Y-%m-%d %H:%M:%S')
+            print(f"Duplicate notification detected. Last sent at {last_time}")
+            return True
     except Exception as e:
         print(f"Error checking duplicate notification: {e}")
     
-    # Save current notification data
+    # Save current notification data atomically so a crashed run never leaves a truncated file
     try:
-        with open(LAST_NOTIFICATION_FILE, 'w') as f:
-            data = {
-                'hash': current_hash,
-                'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'long_calls_count': len(long_calls),
-                'in_progress_calls_count': len(in_progress_calls)
-            }
-            json.dump(data, f)
+        epoch = int(time.time())
+        # Each run writes its own temp file, so overlapping runs never truncate each other's
+        f = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(LAST_NOTIFICATION_FILE), delete=False)
+        try:
+            with f:
+                f.write(f"{current_hash} {epoch}\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f.name, LAST_NOTIFICATION_FILE)
+        except BaseException:
+            # Don't leave the temp file behind if any step failed
+            os.unlink(f.name)
+            raise
+        _dedup_cache['last_notification'] = (current_hash, epoch, time.monotonic())
     except Exception as e:
         print(f"Error saving notification data: {e}")
     
     return False
 
-def send_notification(long_calls, in_progress_calls):
+def send_notification(long_calls: List[CallInfo], in_progress_calls: List[CallInfo]) -> None:
     """Send email notification about detected calls."""
     if not long_calls and not in_progress_calls:
         print("No calls to report.")
         return
     
-    # Check if this is a duplicate notification
-    if is_duplicate_notification(long_calls, in_progress_calls):
-        print("Skipping duplicate notification")
-        return
+    # Imported only once a notification is actually going out
+    from sendgrid.helpers.mail import Mail
     
     # Create message content
     subject = "Twilio Call Monitor Alert"
     
-    content = []
-    content.append("Twilio Call Monitor has detected the following calls:\n")
+    content = io.StringIO()
+    content.write("Twilio Call Monitor has detected the following calls:\n\n")
     
     if long_calls:
-        content.append("🔴 Calls longer than 10 minutes:")
+        content.write("🔴 Calls longer than 10 minutes:\n")
         for call in long_calls:
-            content.append(f"  • From: {call['from_number']}")
-            content.append(f"    To: {call['to_number']}")
-            content.append(f"    Duration: {call['duration']}")
-            content.append(f"    Started: {call['start_time']}")
-            content.append("")
+            content.write(f"  • From: {call.from_number}\n")
+            content.write(f"    To: {call.to_number}\n")
+            content.write(f"    Duration: {call.duration}\n")
+            content.write(f"    Started: {format_start_time(call.start_time)}\n")
+            content.write("\n")
     
     if in_progress_calls:
-        content.append("🟡 Calls currently in progress:")
+        content.write("🟡 Calls currently in progress:\n")
         for call in in_progress_calls:
-            content.append(f"  • From: {call['from_number']}")
-            content.append(f"    To: {call['to_number']}")
-            content.append(f"    Started: {call['start_time']}")
-            content.append(f"    Status: {call['status']}")
-            content.append("")
+            content.write(f"  • From: {call.from_number}\n")
+            content.write(f"    To: {call.to_number}\n")
+            content.write(f"    Started: {format_start_time(call.start_time)}\n")
+            content.write(f"    Status: {call.status}\n")
+            content.write("\n")
     
-    content.append("This is an automated notification from Twilio Call Monitor.")
+    content.write("This is an automated notification from Twilio Call Monitor.")
     
+    # Each recipient gets its own personalization within a single send request
     message = Mail(
         from_email=FROM_EMAIL,
-        to_emails=NOTIFICATION_EMAIL,
+        to_emails=NOTIFICATION_RECIPIENTS,
         subject=subject,
-        plain_text_content="\n".join(content)
+        plain_text_content=content.getvalue(),
+        is_multiple=True
     )
     
     try:
-        sg = SendGridAPIClient(SENDGRID_API_KEY)
+        sg = get_sendgrid_client()
         response = sg.send(message)
         print(f"Email sent with status code: {response.status_code}")
     except Exception as e:
         print(f"Error sending email: {e}")
 
-def monitor_calls():
+def build_active_call_info(call: CallInstance, status: str, window_ts: float) -> Optional[CallInfo]:
+    """Return CallInfo for an active call that started within the window, else None."""
+    start_dt = call.start_time
+    if not start_dt or start_dt.timestamp() < window_ts:
+        return None
+    return CallInfo(
+        sid=call.sid,
+        from_number=call.from_formatted,
+        to_number=call.to_formatted,
+        status=status,
+        start_time=start_dt,
+        duration='In progress'
+    )
+
+def build_long_call_info(call: CallInstance, status: str, window_ts: float) -> Optional[CallInfo]:
+    """Return CallInfo for a completed long call that ended within the window, else None."""
+    # Check duration first since it rejects most calls
+    duration = call.duration
+    try:
+        if not duration or int(duration) < LONG_CALL_THRESHOLD:
+            return None
+    except (ValueError, TypeError) as e:
+        print(f"Error processing duration for call {call.sid}: {e}")
+        return None
+    
+    end_dt = getattr(call, 'end_time', None)
+    if not end_dt or end_dt.timestamp() < window_ts:
+        return None
+    
+    return CallInfo(
+        sid=call.sid,
+        from_number=call.from_formatted,
+        to_number=call.to_formatted,
+        status=status,
+        start_time=call.start_time,
+        duration=format_duration(duration)
+    )
+
+def run_call_query(params: Dict[str, Any]) -> List[CallInstance]:
+    """Run a single filtered Twilio call query on its own client."""
+    client = create_twilio_client()
+    return list(client.calls.stream(limit=100, **params))
+
+def fetch_recent_calls(window_start: datetime) -> List[CallInstance]:
+    """Fetch completed and active calls for the window, running the queries concurrently."""
+    queries: List[Dict[str, Any]] = [
+        {'status': 'completed', 'end_time_after': window_start},
+        *({'status': status, 'start_time_after': window_start} for status in sorted(ACTIVE_STATUSES)),
+    ]
+    
+    # Each query is an independent HTTPS round trip, so overlap their latency
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        futures = [executor.submit(run_call_query, params) for params in queries]
+        return list(itertools.chain.from_iterable(future.result() for future in futures))
+
+def latest_calls_by_sid(calls: List[CallInstance]) -> List[CallInstance]:
+    """Keep one entry per SID, in SID order, using the most advanced status seen."""
+    # The status queries run at different moments, so a call can appear in more than one
+    latest: Dict[str, Tuple[int, CallInstance]] = {}
+    for call in calls:
+        sid = call.sid or ''
+        rank = _STATUS_PROGRESSION.get(cast(Optional[str], call.status) or '', -1)
+        if sid not in latest or rank > latest[sid][0]:
+            latest[sid] = (rank, call)
+    return [latest[sid][1] for sid in sorted(latest)]
+
+def monitor_calls() -> None:
     """Monitor Twilio calls and detect long or in-progress calls."""
     # Validate required environment variables
     if not all([TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, SENDGRID_API_KEY, NOTIFICATION_EMAIL, FROM_EMAIL]):
@@ -156,63 +275,54 @@ def monitor_calls():
         print("Please set TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, SENDGRID_API_KEY, NOTIFICATION_EMAIL, and FROM_EMAIL.")
         sys.exit(1)
     
+    if not NOTIFICATION_RECIPIENTS:
+        print("Error: NOTIFICATION_EMAIL does not contain any email addresses.")
+        sys.exit(1)
+    
     print(f"Starting Twilio call monitoring at {datetime.now()}")
     
     try:
-        # Initialize Twilio client
-        client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-
         # Define window for recent call data (last 10 minutes)
-        window_start = datetime.utcnow() - timedelta(minutes=10)
+        window_start = datetime.now(timezone.utc) - timedelta(minutes=10)
+        window_ts = window_start.timestamp()
 
-        # Fetch calls (adjust limit as needed)
-        calls = client.calls.list(limit=100)
+        # Fetch only calls relevant to the window, filtered on the Twilio side
+        # Process in SID order, once per call, so the dedup hash can be built during the pass
+        calls = latest_calls_by_sid(fetch_recent_calls(window_start))
+        notification_hash = hashlib.blake2b(digest_size=16)
 
-        long_calls = []
-        in_progress_calls = []
+        long_calls: List[CallInfo] = []
+        in_progress_calls: List[CallInfo] = []
 
+        # Partition calls in a single pass, dispatching on status
+        handlers: Dict[str, Tuple[Callable[[CallInstance, str, float], Optional[CallInfo]], List[CallInfo]]] = {
+            'active': (build_active_call_info, in_progress_calls),
+            'long': (build_long_call_info, long_calls),
+        }
         for call in calls:
-            # Parse start and end times
-            start_dt = call.start_time.replace(tzinfo=None) if call.start_time else None
-            end_dt = call.end_time.replace(tzinfo=None) if getattr(call, 'end_time', None) else None
-
-            # Detect in-progress calls that started within the window
-            if call.status in ['in-progress', 'ringing', 'queued']:
-                if start_dt and start_dt >= window_start:
-                    call_info = {
-                        'sid': call.sid,
-                        'from_number': call.from_formatted,
-                        'to_number': call.to_formatted,
-                        'status': call.status,
-                        'start_time': start_dt.strftime('%Y-%m-%d %H:%M:%S'),
-                        'duration': 'In progress'
-                    }
-                    in_progress_calls.append(call_info)
+            # Twilio annotates status as CallInstance.Status, but the payload value is a plain string
+            status = cast(Optional[str], call.status)
+            if status is None:
                 continue
-
-            # Detect completed long calls that ended within the window
-            if call.status == 'completed' and end_dt and end_dt >= window_start:
-                try:
-                    if call.duration and int(call.duration) >= LONG_CALL_THRESHOLD:
-                        call_info = {
-                            'sid': call.sid,
-                            'from_number': call.from_formatted,
-                            'to_number': call.to_formatted,
-                            'status': call.status,
-                            'start_time': start_dt.strftime('%Y-%m-%d %H:%M:%S') if start_dt else 'Unknown',
-                            'duration': format_duration(call.duration)
-                        }
-                        long_calls.append(call_info)
-                except (ValueError, TypeError) as e:
-                    print(f"Error processing duration for call {call.sid}: {e}")
+            action = _STATUS_DISPATCH.get(status)
+            if action is None:
+                continue
+            build, bucket = handlers[action]
+            call_info = build(call, status, window_ts)
+            if call_info is not None:
+                bucket.append(call_info)
+                notification_hash.update(f"{call_info.sid}:{call_info.status}:{call_info.duration}|".encode())
 
         # Print summary
         print(f"Found {len(long_calls)} calls longer than 10 minutes in last 10 minutes")
         print(f"Found {len(in_progress_calls)} calls currently in progress within last 10 minutes")
         
-        # Send notification if needed
+        # Send notification if needed, checking for duplicates before any email is built
         if long_calls or in_progress_calls:
-            send_notification(long_calls, in_progress_calls)
+            if is_duplicate_notification(notification_hash.hexdigest()):
+                print("Skipping duplicate notification")
+            else:
+                send_notification(long_calls, in_progress_calls)
         
     except Exception as e:
         print(f"Error in monitor_calls: {e}")